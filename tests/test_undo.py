@@ -16,20 +16,116 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from collections import deque
+import os
+import time
+import weakref
+
+import pytest
 
 import undo
 
+# The default stack, captured before any test calls setstack().
+_IMPORT_STACK = undo.stack()
+
+# Timing tests only run when UNDO_BENCH_N is set.
+benchmark = pytest.mark.skipif('UNDO_BENCH_N' not in os.environ,
+                               reason='benchmark only, set UNDO_BENCH_N to run')
+
+
+@undo.undoable
+def add(seq, item):
+    'A simple undoable action shared by several tests.'
+    seq.append(item)
+    pos = len(seq) - 1
+    yield 'add @{} to {}'.format(pos, seq)
+    del seq[pos]
+
+
+# A complicated nested case: each action undoes itself with the other.
+@undo.undoable
+def nested_add(seq, item):
+    seq.append(item)
+    yield 'Add'
+    nested_delete(seq)
+
+
+@undo.undoable
+def nested_delete(seq):
+    value = seq.pop()
+    yield 'Delete'
+    nested_add(seq, value)
+
+
+class List:
+    'A container with an undoable method.'
+
+    def __init__(self):
+        self._l = []
+
+    @undo.undoable
+    def add(self, item):
+        self._l.append(item)
+        yield 'Add an item'
+        self._l.pop()
+
+
+class Mod:
+    'A container with several undoable methods.'
+
+    def __init__(self):
+        self.l = set()
+
+    @undo.undoable
+    def add(self, value):
+        self.l.add(value)
+        yield 'Add {value}'
+        self.l.remove(value)
+
+    @undo.undoable
+    def delete(self, value):
+        self.l.remove(value)
+        yield 'Delete {value}'
+        self.l.add(value)
+
+
+@undo.undoable
+def add_item(seq, item):
+    seq.append(item)
+    yield 'Add 1 item'
+    seq.pop()
+
+
+class StubAction:
+    'A minimal action for use in stack tests.'
+    __slots__ = ()
+
+    def do(self):
+        pass
+
+    def undo(self):
+        pass
+
+    def text(self):
+        return 'blah'
+
 
 class TestSetStack:
     'Test setting and calling the current stack'
 
+    def setup_method(self):
+        undo.setstack(undo.Stack())
+
     def test_init_stack(self):
-        'Test that a new stack is created'
-        undo._stack = None
+        'Test that a default stack is created on import'
+        assert isinstance(_IMPORT_STACK, undo.Stack)
+
+    def test_setstack_none(self):
+        'Test that setting None installs a new stack'
+        old = undo.stack()
+        undo.setstack(None)
         stack = undo.stack()
-        assert stack is undo._stack
         assert isinstance(stack, undo.Stack)
+        assert stack is not old
 
     def test_setstack(self):
         'Test that a new stack can be set'
@@ -44,7 +140,7 @@ class TestSetStack:
 class TestUndoable:
     'Test undoble as a generator.'
 
-    def setup(self):
+    def setup_method(self):
         #Set undo.stack() to a list, stored as self.stack
         self.stack = []
         undo.setstack(self.stack)
@@ -97,6 +193,17 @@ class TestUndoable:
         a = A()
         a.f(1, 2)
 
+    def test_kwargs(self):
+        'Test that keyword arguments are passed on do and redo.'
+        calls = []
+        @undo.undoable
+        def f(arg, kwarg=None):
+            calls.append((arg, kwarg))
+            yield
+        f(1, kwarg=2)
+        self.stack[0].do()
+        assert calls == [(1, 2), (1, 2)]
+
     def test_method_instances(self):
         'Test that multiple instances do not share actions.'
         class A:
@@ -130,223 +237,405 @@ class TestUndoable:
 
 class TestGroup:
 
-    def setup(self):
+    def setup_method(self):
         undo.setstack(undo.Stack())
 
     def test_stack(self):
         'Test that ``with group()`` diverts undo.stack()'
-        undo.stack().clear()
         _Group = undo._Group('')
         stack = []
         _Group._stack = stack
-        assert undo.stack()._receiver == undo.stack()._undos
+        assert undo.stack()._receiver is undo.stack()._undos
         assert undo.stack().undocount() == 0
         with _Group:
-            assert undo.stack()._receiver == stack
-        assert undo.stack()._receiver == undo.stack()._undos
+            assert undo.stack()._receiver is stack
+        assert undo.stack()._receiver is undo.stack()._undos
         assert undo.stack().undocount() == 1
         assert stack == []
-        assert undo.stack()._undos == deque([_Group])
+        assert undo.stack()._undos[-1] is _Group
 
     def test_group(self):
         'Test that ``group()`` returns a context manager.'
         with undo.group('desc'):
             pass
 
+    def test_order(self):
+        'Test that a group redoes in order and undoes in reverse.'
+        calls = []
+        class Action:
+            def __init__(self, name):
+                self.name = name
+            def do(self):
+                calls.append(('do', self.name))
+            def undo(self):
+                calls.append(('undo', self.name))
+        _Group = undo._Group('')
+        _Group._stack = [Action('one'), Action('two'), Action('three')]
+        _Group.undo()
+        _Group.do()
+        assert calls == [('undo', 'three'), ('undo', 'two'), ('undo', 'one'),
+                         ('do', 'one'), ('do', 'two'), ('do', 'three')]
+
+    def test_text_escaped_braces(self):
+        'Test that escaped braces in the description are unescaped.'
+        assert undo._Group('keep }} literal').text() == 'keep } literal'
+        assert undo._Group('keep {{ literal').text() == 'keep { literal'
+
     def test_group_multiple_undo(self):
         'Test that calling undo after a group undoes all actions.'
-        @undo.undoable
-        def add(seq, v):
-            seq.append(v)
-            yield 'add'
-            seq.pop()
-
+        stack = undo.stack()
         l = []
         with undo.group('desc'):
             for i in range(3):
                 add(l, i)
 
         assert l == [0, 1, 2], l
-        assert undo.stack().undocount() == 1
-        undo.stack().undo()
-        assert undo.stack().undocount() == 0
+        assert stack.undocount() == 1
+        stack.undo()
+        assert stack.undocount() == 0
         assert l == [], l
 
+    def test_group_text(self):
+        'Test that the group description is formatted with the count.'
+        stack = undo.stack()
+        l = []
+        with undo.group('add {count} items'):
+            for i in range(3):
+                add(l, i)
+
+        assert stack.undotext() == 'Undo add 3 items'
+        stack.undo()
+        assert stack.redotext() == 'Redo add 3 items'
+
 
 class TestStack:
 
-    def setup(self):
-        # Create a mock action for use in tests
-        class Action:
-            def do(self): pass
-            def undo(self): pass
-            def text(self):
-                return 'blah'
-        self.action = Action()
+    # The stub is stateless, so all tests can share one instance.
+    action = StubAction()
+
+    def setup_method(self):
         undo.setstack(undo.Stack())
 
+    def test_instance_attributes(self):
+        'Stack instances support weak references and patched methods.'
+        stack = undo.stack()
+        assert weakref.ref(stack)() is stack
+        stack.append = lambda action: None
+        stack.append('one')
+        assert stack._undos == []
+
     def test_singleton(self):
         'undo.stack() always returns the same object'
         assert undo.stack() is undo.stack()
 
     def test_append(self):
         'undo.stack().append adds actions to the undo queue.'
-        undo.stack().append('one')
-        assert undo.stack()._undos == deque(['one'])
+        stack = undo.stack()
+        stack.append('one')
+        assert stack._undos == ['one']
 
     def test_undo_changes_stacks(self):
         'Calling undo updates both the undos and redos stacks.'
-        undo.stack()._undos = deque([1, 2, self.action])
-        undo.stack()._redos = deque([4, 5, 6])
-        undo.stack().undo()
-        assert undo.stack()._undos == deque([1, 2])
-        assert undo.stack()._redos == deque([4, 5, 6, self.action])
+        stack = undo.stack()
+        stack._undos = [1, 2, self.action]
+        stack._redos = [4, 5, 6]
+        stack.undo()
+        assert stack._undos == [1, 2]
+        assert stack._redos == [4, 5, 6, self.action]
+        assert stack._redos[-1] is self.action
 
     def test_undo_resets_redos(self):
         'Calling undo clears any available redos.'
-        undo.stack()._undos = deque([1, 2, 3])
-        undo.stack()._redos = deque([4, 5, 6])
-        undo.stack()._receiver = undo.stack()._undos
-        undo.stack().append(7)
-        assert undo.stack()._undos == deque([1, 2, 3, 7])
-        assert undo.stack()._redos == deque([])
+        stack = undo.stack()
+        stack._undos = [1, 2, 3]
+        stack._redos = [4, 5, 6]
+        stack._receiver = stack._undos
+        stack.append(7)
+        assert stack._undos == [1, 2, 3, 7]
+        assert stack._redos == []
+
+    def test_counts(self):
+        'undocount() and redocount() report their own stacks.'
+        stack = undo.stack()
+        stack._undos = [1, 2, 3]
+        stack._redos = [4]
+        assert stack.undocount() == 3
+        assert stack.redocount() == 1
+
+    def test_undo_pauses_receiver(self):
+        'Actions appended while undoing or redoing are not recorded.'
+        class Action:
+            def do(self):
+                undo.stack().append('redone')
+            def undo(self):
+                undo.stack().append('undone')
+        action = Action()
+        stack = undo.stack()
+        stack._undos = [action]
+        stack.undo()
+        assert stack._undos == []
+        assert stack._redos == [action]
+        stack.redo()
+        assert stack._undos == [action]
+        assert stack._redos == []
+        assert stack._receiver is stack._undos
 
     def test_undotext(self):
         'undo.stack().undotext() returns a description of the undo available.'
-        undo.stack()._undos = [self.action]
-        assert undo.stack().undotext() == 'Undo blah'
+        stack = undo.stack()
+        stack._undos = [self.action]
+        assert stack.undotext() == 'Undo blah'
 
     def test_redotext(self):
         'undo.stack().redotext() returns a description of the redo available.'
-        undo.stack()._redos = [self.action]
-        assert undo.stack().redotext() == 'Redo blah'
+        stack = undo.stack()
+        stack._redos = [self.action]
+        assert stack.redotext() == 'Redo blah'
 
     def test_receiver(self):
         'Test that setreceiver and resetreceiver behave correctly.'
-        stack = []
-        undo.stack()._undos = []
-        undo.stack().setreceiver(stack)
-        undo.stack().append('item')
-        assert stack == ['item']
-        assert undo.stack()._undos == []
-        undo.stack().resetreceiver()
-        undo.stack().append('next item')
-        assert stack == ['item']
-        assert undo.stack()._undos == ['next item']
+        stack = undo.stack()
+        receiver = []
+        stack._undos = []
+        stack.setreceiver(receiver)
+        stack.append('item')
+        assert receiver == ['item']
+        assert stack._undos == []
+        stack.resetreceiver()
+        stack.append('next item')
+        assert receiver == ['item']
+        assert stack._undos == ['next item']
+
+    @benchmark
+    def test_receiver_bulk(self):
+        'Check that appending to a receiver stays fast for many actions.'
+        n = int(os.environ['UNDO_BENCH_N'])
+        stack = undo.stack()
+        receiver = []
+        stack.setreceiver(receiver)
+        start = time.perf_counter()
+        for i in range(n):
+            stack.append(i)
+        elapsed = time.perf_counter() - start
+        assert receiver == list(range(n))
+        assert stack._undos == []
+        assert elapsed < 1.0, elapsed
+
+    def test_receiver_none(self):
+        'Test that actions are discarded while the receiver is None.'
+        stack = undo.stack()
+        stack.setreceiver()
+        stack.append('item')
+        assert stack._undos == []
 
     def test_savepoint(self):
         'Test that savepoint behaves correctly.'
-        undo.stack()._undos = deque([1, 2])
-        assert undo.stack().haschanged()
-        undo.stack().savepoint()
-        assert not undo.stack().haschanged()
-        undo.stack()._undos.pop()
-        assert undo.stack().haschanged()
+        stack = undo.stack()
+        stack._undos = [1, 2]
+        assert stack.haschanged()
+        stack.savepoint()
+        assert not stack.haschanged()
+        stack._undos.pop()
+        assert stack.haschanged()
 
     def test_savepoint_clear(self):
         'Check that clearing the stack resets the savepoint.'
-        undo.stack()._undos = deque()
-        assert undo.stack().haschanged()
-        undo.stack().savepoint()
-        assert not undo.stack().haschanged()
-        undo.stack().clear()
-        assert undo.stack().haschanged()
-        undo.stack().savepoint()
-        assert not undo.stack().haschanged()
-        undo.stack().clear()
-        assert undo.stack().haschanged()
+        stack = undo.stack()
+        stack._undos = []
+        assert stack.haschanged()
+        stack.savepoint()
+        assert not stack.haschanged()
+        stack.clear()
+        assert stack.haschanged()
+        stack.savepoint()
+        assert not stack.haschanged()
+        stack.clear()
+        assert stack.haschanged()
+
+    def test_maxlen(self):
+        'Test that the oldest undos are discarded beyond maxlen.'
+        stack = undo.Stack(maxlen=3)
+        undo.setstack(stack)
+        for i in range(5):
+            stack.append(i)
+        assert stack._undos == [2, 3, 4]
+
+    def test_maxlen_negative(self):
+        'Test that a negative maxlen is rejected.'
+        with pytest.raises(ValueError):
+            undo.Stack(maxlen=-1)
+
+    def test_maxlen_not_integer(self):
+        'Test that a non-integer maxlen is rejected.'
+        for maxlen in (1.5, '3'):
+            with pytest.raises(TypeError):
+                undo.Stack(maxlen=maxlen)
+
+    def test_maxlen_savepoint(self):
+        'Test that the savepoint follows actions discarded by maxlen.'
+        stack = undo.Stack(maxlen=2)
+        undo.setstack(stack)
+        stack.append(self.action)
+        stack.savepoint()
+        stack.append(self.action)
+        stack.append(self.action)
+        assert stack.undocount() == 2
+        stack.undo()
+        assert stack.haschanged()
+        stack.undo()
+        assert not stack.haschanged()
+
+    def test_maxlen_savepoint_discarded(self):
+        'Test that a discarded savepoint is never reported as unchanged.'
+        stack = undo.Stack(maxlen=2)
+        undo.setstack(stack)
+        stack.savepoint()
+        for i in range(3):
+            stack.append(self.action)
+        stack.undo()
+        stack.undo()
+        assert stack.undocount() == 0
+        assert stack.haschanged()
 
 
 class TestSystem:
     'A series of system tests'
 
-    def setup(self):
+    def setup_method(self):
         undo.setstack(undo.Stack())
 
-    def setup_common(self):
-        @undo.undoable
-        def add(seq, item):
-            seq.append(item)
-            pos = len(seq) - 1
-            yield 'add @{pos} to {seq}'.format(pos, seq)
-            del seq[pos]
-        return add
-
-    def setup_bound1(self):
-        class List:
-            def __init__(self):
-                self._l = []
-
-            @undo.undoable
-            def add(self, item):
-                self._l.append(item)
-                yield 'Add an item'
-                self._l.pop()
-        return List
-
-    def setup_bound2(self):
-        class Mod:
-            def __init__(self):
-                self.l = set()
-
-            @undo.undoable
-            def add(self, value):
-                self.l.add(value)
-                yield 'Add {value}'
-                self.l.remove(value)
-
-            @undo.undoable
-            def delete(self, value):
-                self.l.remove(value)
-                yield 'Delete {value}'
-                self.l.add(value)
-
-        return Mod
-
-    def setup_groups1(self):
-        @undo.undoable
-        def add(state, seq, item):
-            seq.append(item)
-            pos = len(seq) - 1
-            yield 'add @{pos} to {seq}'
-            del seq[pos]
-        return add
-
-    def setup_groups2(self):
-        @undo.undoable()
-        def add(state, seq, item):
-            seq.append(item)
-            yield 'Add 1 item'
-            seq.pop()
-        return add
+    def test_common(self):
+        'Test undoing and redoing a plain function.'
+        stack = undo.stack()
+        sequence = [1, 2, 3, 4]
+        add(sequence, 5)
+        assert sequence == [1, 2, 3, 4, 5]
+        assert stack.undotext() == 'Undo add @4 to [1, 2, 3, 4, 5]'
+        stack.undo()
+        assert sequence == [1, 2, 3, 4]
+        assert stack.redotext() == 'Redo add @4 to [1, 2, 3, 4, 5]'
+        stack.redo()
+        assert sequence == [1, 2, 3, 4, 5]
+        assert stack.undotext() == 'Undo add @4 to [1, 2, 3, 4, 5]'
+
+    def test_bound1(self):
+        'Test undoing and redoing a method.'
+        stack = undo.stack()
+        l = List()
+        l.add(5)
+        l.add(3)
+        assert l._l == [5, 3]
+        assert stack.undotext() == 'Undo Add an item'
+        stack.undo()
+        assert l._l == [5]
+        stack.undo()
+        assert l._l == []
+        stack.redo()
+        stack.redo()
+        assert l._l == [5, 3]
+
+    def test_bound2(self):
+        'Test several undoable methods on one instance.'
+        stack = undo.stack()
+        m = Mod()
+        m.add(1)
+        m.add(2)
+        m.delete(1)
+        assert m.l == set([2])
+        stack.undo()
+        assert m.l == set([1, 2])
+        stack.undo()
+        assert m.l == set([1])
+        stack.redo()
+        stack.redo()
+        assert m.l == set([2])
+
+    @pytest.mark.parametrize('n', [3, 10, 1000])
+    def test_groups1(self, n):
+        'Test undoing and redoing a group of actions.'
+        stack = undo.stack()
+        sequence = [1, 2, 3, 4]
+        items = list(range(5, 5 + n))
+        with undo.group('add many'):
+            for i in items:
+                add_item(sequence, i)
+        assert sequence == [1, 2, 3, 4] + items
+        assert stack.undotext() == 'Undo add many'
+        stack.undo()
+        assert sequence == [1, 2, 3, 4]
+        assert stack.redotext() == 'Redo add many'
+        stack.redo()
+        assert sequence == [1, 2, 3, 4] + items
+
+    def test_groups2(self):
+        'Test that a group description can include the action count.'
+        stack = undo.stack()
+        sequence = []
+        with undo.group('Add {count} items'):
+            for item in [4, 6, 8]:
+                add_item(sequence, item)
+        add_item(sequence, 10)
+        assert sequence == [4, 6, 8, 10]
+        stack.undo()
+        assert stack.undotext() == 'Undo Add 3 items'
+        stack.undo()
+        assert sequence == []
+
+    @benchmark
+    def test_groups_bulk(self):
+        'Check that a large group is done, undone and redone quickly.'
+        stack = undo.stack()
+        n = int(os.environ['UNDO_BENCH_N'])
+        sequence = []
+        start = time.perf_counter()
+        with undo.group('Add {count} items'):
+            for item in range(n):
+                add_item(sequence, item)
+        stack.undo()
+        assert sequence == []
+        stack.redo()
+        elapsed = time.perf_counter() - start
+        assert sequence == list(range(n))
+        assert elapsed < 1.0, elapsed
 
 
 class TestNested:
     'Test nested actions'
 
-    def setup(self):
-        # Test a complicated nested case
-        @undo.undoable
-        def add(seq, item):
-            seq.append(item)
-            yield 'Add'
-            delete(seq)
-
-        @undo.undoable
-        def delete(seq):
-            value = seq.pop()
-            yield 'Delete'
-            add(seq, value)
-
-        self.add = add
-        self.delete = delete
+    def setup_method(self):
         undo.setstack(undo.Stack())
 
+    def test_add(self):
+        'Actions called while undoing are not added to the stack.'
+        stack = undo.stack()
+        sequence = []
+        nested_add(sequence, 1)
+        assert sequence == [1]
+        stack.undo()
+        assert sequence == []
+        assert stack.undocount() == 0
+        assert stack.redocount() == 1
+        stack.redo()
+        assert sequence == [1]
+        assert stack.undocount() == 1
+        assert stack.redocount() == 0
+
+    def test_delete(self):
+        'Test undoing an action which undoes itself with another.'
+        stack = undo.stack()
+        sequence = [1, 2]
+        nested_delete(sequence)
+        assert sequence == [1]
+        stack.undo()
+        assert sequence == [1, 2]
+        assert stack.undotext() is None
+        assert stack.redotext() == 'Redo Delete'
+
 
 class TestExceptions:
     'Test how exceptions within actions are handled.'
 
-    def setup(self):
+    def setup_method(self):
         undo.setstack(undo.Stack())
         @undo.undoable
         def action():
@@ -364,7 +653,7 @@ class TestExceptions:
             yield 'desc'
         return add
 
-    def test_undo(self):
+    def setup_undo(self):
         @undo.undoable
         def add():
             yield 'desc'
@@ -372,14 +661,42 @@ class TestExceptions:
                 self.calls = 1
             else:
                 raise TypeError
-
         return add
 
     def setup_do(self):
         @undo.undoable
-        def add(state):
+        def add():
             raise TypeError
             yield 'desc'
-            self.fail('Undo should not be called')
+            assert False, 'Undo should not be called'
         return add
 
+    def test_redo(self):
+        'An exception while redoing is raised and clears the stack.'
+        add = self.setup_redo()
+        add()
+        undo.stack().undo()
+        with pytest.raises(TypeError):
+            undo.stack().redo()
+        assert not undo.stack().canundo()
+        assert not undo.stack().canredo()
+
+    def test_undo(self):
+        'An exception while undoing is raised and clears the stack.'
+        add = self.setup_undo()
+        self.action()
+        add()
+        undo.stack().undo()
+        undo.stack().redo()
+        with pytest.raises(TypeError):
+            undo.stack().undo()
+        assert not undo.stack().canundo()
+        assert not undo.stack().canredo()
+
+    def test_do(self):
+        'An exception in the action itself is raised and nothing is added.'
+        add = self.setup_do()
+        self.action()
+        with pytest.raises(TypeError):
+            add()
+        assert undo.stack().undocount() == 1
@@ -22,11 +22,9 @@ __author__ = 'David Townshend'
 
 __all__ = ['undoable', 'group', 'Stack', 'stack', 'setstack']
 
-import contextlib
+import operator
 
-from collections import deque
-
-class _Action:
+class _Action(object):
     ''' This represents an action which can be done and undone.
     
     It is the result of a call on an undoable function and has
@@ -35,6 +33,8 @@ class _Action:
     subsequently be returned by ``text``.  Any remaining values are 
     returned by ``do()``.
     '''
+    __slots__ = ('_generator', 'args', 'kwargs', '_text', '_runner')
+
     def __init__(self, generator, args, kwargs):
         self._generator = generator
         self.args = args
@@ -43,7 +43,10 @@ class _Action:
 
     def do(self):
         'Do or redo the action'
-        self._runner = self._generator(*self.args, **self.kwargs)
+        if self.kwargs:
+            self._runner = self._generator(*self.args, **self.kwargs)
+        else:
+            self._runner = self._generator(*self.args)
         rets = next(self._runner)
         if isinstance(rets, tuple):
             self._text = rets[0]
@@ -83,7 +86,7 @@ def undoable(generator):
     def inner(*args, **kwargs):
         action = _Action(generator, args, kwargs)
         ret = action.do()
-        stack().append(action)
+        _stack.append(action)
         if isinstance(ret, tuple):
             if len(ret) == 1:
                 return ret[0]
@@ -93,20 +96,27 @@ def undoable(generator):
     return inner
 
 
-class _Group:
+class _Group(object):
     ''' A undoable group context manager. '''
+    __slots__ = ('_desc', '_stack', '_text')
 
     def __init__(self, desc):
         self._desc = desc
         self._stack = []
+        # Descriptions without fields or escaped braces need no formatting.
+        if '{' in desc or '}' in desc:
+            self._text = None
+        else:
+            self._text = desc
 
     def __enter__(self):
-        stack().setreceiver(self._stack)
+        _stack.setreceiver(self._stack)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is None:
-            stack().resetreceiver()
-            stack().append(self)
+            current = _stack
+            current.resetreceiver()
+            current.append(self)
         return False
 
     def undo(self):
@@ -118,7 +128,11 @@ class _Group:
             undoable.do()
 
     def text(self):
-        return self._desc.format(count=len(self._stack))
+        # The group cannot change once it is on the stack, so the text
+        # only needs formatting once.
+        if self._text is None:
+            self._text = self._desc.format(count=len(self._stack))
+        return self._text
 
 
 def group(desc):
@@ -145,7 +159,7 @@ def group(desc):
     return _Group(desc)
 
 
-class Stack:
+class Stack(object):
     ''' The main undo stack. 
         
     The two key features are the :func:`redo` and :func:`undo` methods. If an 
@@ -192,11 +206,20 @@ class Stack:
     >>> action()
     >>> stack().haschanged()
     True
+
+    The length of the undo history can be limited by passing *maxlen*.
+    Once the limit is reached, the oldest action is discarded whenever a
+    new one is added.  By default the history is unbounded.
     '''
 
-    def __init__(self):
-        self._undos = deque()
-        self._redos = deque()
+    def __init__(self, maxlen=None):
+        if maxlen is not None:
+            maxlen = operator.index(maxlen)
+            if maxlen < 0:
+                raise ValueError('maxlen must be non-negative')
+        self._maxlen = maxlen
+        self._undos = []
+        self._redos = []
         self._receiver = self._undos
         self._savepoint = None
         self.undocallback = lambda: None
@@ -218,34 +241,40 @@ class Stack:
         '''
         if self.canredo():
             undoable = self._redos.pop()
-            with self._pausereceiver():
-                try:
-                    undoable.do()
-                except:
-                    self.clear()
-                    raise
-                else:
-                    self._undos.append(undoable)
+            # Pause the receiver so that actions triggered by redoing are
+            # not recorded.
+            self._receiver = None
+            try:
+                undoable.do()
+            except:
+                self.clear()
+                raise
+            else:
+                self._undos.append(undoable)
+            finally:
+                self._receiver = self._undos
             self.docallback()
 
     def undo(self):
         ''' Undo the last action. '''
         if self.canundo():
             undoable = self._undos.pop()
-            with self._pausereceiver():
-                try:
-                    undoable.undo()
-                except:
-                    self.clear()
-                    raise
-                else:
-                    self._redos.append(undoable)
+            self._receiver = None
+            try:
+                undoable.undo()
+            except:
+                self.clear()
+                raise
+            else:
+                self._redos.append(undoable)
+            finally:
+                self._receiver = self._undos
             self.undocallback()
 
     def clear(self):
         ''' Clear the undo list. '''
-        self._undos.clear()
-        self._redos.clear()
+        del self._undos[:]
+        del self._redos[:]
         self._savepoint = None
         self._receiver = self._undos
 
@@ -255,7 +284,7 @@ class Stack:
 
     def redocount(self):
         ''' Return the number of redos available. '''
-        return len(self._undos)
+        return len(self._redos)
 
     def undotext(self):
         ''' Return a description of the next available undo. '''
@@ -267,20 +296,13 @@ class Stack:
         if self.canredo():
             return ('Redo ' + self._redos[-1].text()).strip()
 
-    @contextlib.contextmanager
-    def _pausereceiver(self):
-        ''' Return a contect manager which temporarily pauses the receiver. '''
-        self.setreceiver([])
-        yield
-        self.resetreceiver()
-
     def setreceiver(self, receiver=None):
         ''' Set an object to receiver commands pushed onto the stack.
         
         By default it is the internal stack, but it can be set (usually
-        internally) to any object with an *append()* method.
+        internally) to any object with an *append()* method.  If *receiver*
+        is *None*, appended actions are discarded.
         '''
-        assert hasattr(receiver, 'append')
         self._receiver = receiver
 
     def resetreceiver(self):
@@ -289,11 +311,26 @@ class Stack:
 
     def append(self, action):
         ''' Add a undoable to the stack, using ``receiver.append()``. '''
-        if self._receiver is not None:
-            self._receiver.append(action)
-        if self._receiver is self._undos:
-            self._redos.clear()
+        receiver = self._receiver
+        if receiver is self._undos:
+            receiver.append(action)
+            if self._redos:
+                del self._redos[:]
+            if self._maxlen is not None:
+                self._trim()
             self.docallback()
+        elif receiver is not None:
+            receiver.append(action)
+
+    def _trim(self):
+        ''' Discard the oldest undos in excess of *maxlen*. '''
+        excess = len(self._undos) - self._maxlen
+        if excess > 0:
+            del self._undos[:excess]
+            # The savepoint is an undo count, so it moves with the history.
+            # If it drops below zero the saved state is no longer reachable.
+            if self._savepoint is not None:
+                self._savepoint -= excess
 
     def savepoint(self):
         ''' Set the savepoint. '''
@@ -307,19 +344,21 @@ class Stack:
         return self._savepoint is None or self._savepoint != self.undocount()
 
 
-_stack = None
+_stack = Stack()
 
 def stack():
     ''' Return the currently used stack.
     
-    If no stack has been set, a new one is created and set.
+    A default stack is created when the module is loaded.
     '''
-    global _stack
-    if _stack is None:
-        _stack = Stack()
     return _stack
 
 def setstack(stack):
-    ''' Set the undo stack to a specific `Stack` object.'''
+    ''' Set the undo stack to a specific `Stack` object.
+    
+    If *stack* is *None*, a new `Stack` is created and set.
+    '''
     global _stack
+    if stack is None:
+        stack = Stack()
     _stack = stack